@@ -1,32 +1,39 @@
 import json
-from argparse import ArgumentParser
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from argparse import ArgumentParser, Namespace
+from threading import Event, Thread
+from multiprocessing import Process
 from pathlib import Path
+from typing import Any, Dict, List, Tuple
 
 from avalonplex_core import XmlSerializer, normalize
 
 from avalonplex_scraper.plugin import load_all_plugins
+from avalonplex_scraper.runner import Runner
 from avalonplex_scraper.utils import download_thumbnail
+from avalonplex_scraper.work_queue import WorkQueue, LEASED, PENDING
 
+logger = logging.getLogger(__name__)
 
-def main():
-    parser = ArgumentParser(description="Avalon Plex Xml Scraper")
-    parser.add_argument("runner", metavar="runner", type=str, help="runner")
-    parser.add_argument("-o", "--output", metavar="output", default="", type=str, help="Output")
-    parser.add_argument("-p", "--scrapers_config", type=str, default="scrapers.json", help="Scrapers config file")
-    parser.add_argument("-e", "--episode", type=int, help="Episode")
-    parser.add_argument("-S", "--start", type=int, help="Start episode")
-    parser.add_argument("-E", "--end", type=int, help="End episode")
-    args = parser.parse_args()
-    with open(args.scrapers_config, "r", encoding="utf-8") as file:
-        scrapers_config = json.load(file)
 
-    factories, runners = load_all_plugins()
+def _load_config(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
 
-    runner = runners[args.runner]
-    path = runner.get_output() if args.output.strip() == "" else args.output
-    output = Path(path)
-    output.mkdir(parents=True, exist_ok=True)
 
+def _get_output(runner: Runner, output: str) -> Path:
+    path = Path(runner.get_output() if output.strip() == "" else output)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _get_range(args: Namespace) -> Tuple[int, int]:
     start = args.start
     end = args.end
     if start is None or end is None:
@@ -35,20 +42,183 @@ def main():
     if start is None or end is None:
         start = int(input("Enter start:"))
         end = int(input("Enter end:"))
+    return start, end
+
+
+def _add_range_arguments(parser: ArgumentParser):
+    parser.add_argument("-e", "--episode", type=int, help="Episode")
+    parser.add_argument("-S", "--start", type=int, help="Start episode")
+    parser.add_argument("-E", "--end", type=int, help="End episode")
+
+
+def process(runner: Runner, episode_num: int, scrapers_config: Dict[str, Any], output: Path,
+            xml_serializer: XmlSerializer):
+    episode, thumbnails = runner.run(episode_num, scrapers_config)
+    name = "{0} - s{1:02d}e{2:02d}".format(runner.series, runner.season, episode.episode)
+    if episode.title is not None:
+        episode.title = normalize(episode.title)
+    if episode.plot is not None:
+        episode.plot = normalize(episode.plot)
+    episode.writers = [normalize(w) for w in episode.writers]
+    episode.directors = [normalize(w) for w in episode.directors]
+    # Write into a temporary folder on the same volume and move the files into place, so that workers processing
+    # the same episode at the same time never leave a partially written file.
+    with tempfile.TemporaryDirectory(prefix=".tmp-", dir=str(output)) as temp:
+        temp_path = Path(temp)
+        download_thumbnail(thumbnails, temp_path.joinpath(name))
+        xml_serializer.serialize(episode, f"{name}.xml", temp_path)
+        files = [path.name for path in temp_path.iterdir()]
+        # Remove thumbnails of a previous run which were saved with another extension.
+        for path in output.iterdir():
+            if path.is_file() and path.stem == name and path.name not in files:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+        for file in files:
+            os.replace(str(temp_path.joinpath(file)), str(output.joinpath(file)))
+
+
+def run(argv: List[str]):
+    parser = ArgumentParser(description="Avalon Plex Xml Scraper")
+    parser.add_argument("runner", metavar="runner", type=str, help="runner")
+    parser.add_argument("-o", "--output", metavar="output", default="", type=str, help="Output")
+    parser.add_argument("-p", "--scrapers_config", type=str, default="scrapers.json", help="Scrapers config file")
+    _add_range_arguments(parser)
+    args = parser.parse_args(argv)
+    scrapers_config = _load_config(args.scrapers_config)
+
+    factories, runners = load_all_plugins()
+
+    runner = runners[args.runner]
+    output = _get_output(runner, args.output)
+    start, end = _get_range(args)
 
     xml_serializer = XmlSerializer(ignore_blank=False, ignore_none=False, ignore_empty=False)
 
     for i in range(start, end + 1):
-        episode, thumbnails = runner.run(i, scrapers_config)
-        name = "{0} - s{1:02d}e{2:02d}".format(runner.series, runner.season, episode.episode)
-        download_thumbnail(thumbnails, output.joinpath(name))
-        if episode.title is not None:
-            episode.title = normalize(episode.title)
-        if episode.plot is not None:
-            episode.plot = normalize(episode.plot)
-        episode.writers = [normalize(w) for w in episode.writers]
-        episode.directors = [normalize(w) for w in episode.directors]
-        xml_serializer.serialize(episode, f"{name}.xml", output)
-
-
-main()
+        process(runner, i, scrapers_config, output, xml_serializer)
+
+
+def enqueue(argv: List[str]):
+    parser = ArgumentParser(prog="avalonplex_scraper enqueue", description="Add runner episodes to the work queue")
+    parser.add_argument("runners", metavar="runner", type=str, nargs="*", help="Runners. Default: all runners")
+    parser.add_argument("-q", "--queue", type=str, default="queue.sqlite", help="Work queue database file")
+    parser.add_argument("--reset", action="store_true", help="Set failed tasks back to pending")
+    _add_range_arguments(parser)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    factories, runners = load_all_plugins()
+
+    names = args.runners if len(args.runners) > 0 else list(runners.keys())
+    unknown = [name for name in names if name not in runners]
+    if len(unknown) > 0:
+        parser.error(f"Unknown runner(s): {', '.join(unknown)}")
+    start, end = _get_range(args)
+
+    work_queue = WorkQueue(args.queue)
+    try:
+        for name in names:
+            count = work_queue.enqueue(name, range(start, end + 1), reset=args.reset)
+            logger.info("Enqueued %d task(s) for %s", count, name)
+        print(json.dumps(work_queue.counts()))
+        for name, episode_num, error in work_queue.failures():
+            print(f"Failed: {name} episode {episode_num}\n{error}")
+    finally:
+        work_queue.close()
+
+
+def _heartbeat(args: Namespace, owner: str, name: str, episode_num: int, stop: Event):
+    # SQLite connections cannot be shared between threads, so the heartbeat uses its own.
+    work_queue = WorkQueue(args.queue, lease=args.lease)
+    try:
+        while not stop.wait(args.lease / 3):
+            if not work_queue.renew(owner, name, episode_num):
+                logger.warning("%s cannot renew the lease of %s episode %d", owner, name, episode_num)
+                return
+    finally:
+        work_queue.close()
+
+
+def _work(args: Namespace):
+    logging.basicConfig(level=logging.INFO)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    scrapers_config = _load_config(args.scrapers_config)
+    factories, runners = load_all_plugins()
+    xml_serializer = XmlSerializer(ignore_blank=False, ignore_none=False, ignore_empty=False)
+    work_queue = WorkQueue(args.queue, lease=args.lease, max_attempts=args.max_attempts,
+                           retry_delay=args.retry_delay)
+    try:
+        while True:
+            task = work_queue.lease(owner)
+            if task is None:
+                counts = work_queue.counts()
+                if counts.get(PENDING, 0) + counts.get(LEASED, 0) <= 0:
+                    return
+                # Other workers still hold leases which may expire and need to be retried.
+                time.sleep(args.poll)
+                continue
+            name, episode_num = task
+            runner = runners.get(name)
+            stop = Event()
+            heartbeat = Thread(target=_heartbeat, args=(args, owner, name, episode_num, stop), daemon=True)
+            heartbeat.start()
+            try:
+                if runner is None:
+                    raise ValueError(f"{name} is not a recognizable runner name.")
+                process(runner, episode_num, scrapers_config, _get_output(runner, args.output), xml_serializer)
+            except Exception:
+                logger.exception("%s failed on %s episode %d", owner, name, episode_num)
+                work_queue.fail(owner, name, episode_num, traceback.format_exc())
+                continue
+            finally:
+                stop.set()
+                heartbeat.join()
+            if not work_queue.complete(owner, name, episode_num):
+                logger.warning("%s lost the lease of %s episode %d before completion", owner, name, episode_num)
+    finally:
+        work_queue.close()
+
+
+def worker(argv: List[str]):
+    parser = ArgumentParser(prog="avalonplex_scraper worker", description="Process tasks from the work queue")
+    parser.add_argument("-q", "--queue", type=str, default="queue.sqlite", help="Work queue database file")
+    parser.add_argument("-o", "--output", metavar="output", default="", type=str, help="Output")
+    parser.add_argument("-p", "--scrapers_config", type=str, default="scrapers.json", help="Scrapers config file")
+    parser.add_argument("-j", "--processes", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--lease", type=float, default=600, help="Lease duration in seconds. Renewed every third of it while a task runs")
+    parser.add_argument("--max_attempts", type=int, default=3, help="Attempts before a task is marked as failed")
+    parser.add_argument("--retry_delay", type=float, default=60,
+                        help="Seconds to wait before a failed task is retried, multiplied by its attempts")
+    parser.add_argument("--poll", type=float, default=5, help="Seconds to wait while other workers hold leases")
+    args = parser.parse_args(argv)
+
+    if args.processes <= 1:
+        _work(args)
+        return
+    # Fail early on config and plugin errors instead of in every child process.
+    _load_config(args.scrapers_config)
+    load_all_plugins()
+    processes = [Process(target=_work, args=(args,)) for _ in range(args.processes)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    failed = [p for p in processes if p.exitcode != 0]
+    if len(failed) > 0:
+        logger.error("%d of %d worker process(es) exited with an error", len(failed), len(processes))
+        sys.exit(1)
+
+
+def main():
+    commands = {"enqueue": enqueue, "worker": worker}
+    argv = sys.argv[1:]
+    if len(argv) > 0 and argv[0] in commands:
+        commands[argv[0]](argv[1:])
+    else:
+        run(argv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Tuple, Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    runner TEXT NOT NULL,
+    episode INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    not_before REAL,
+    error TEXT,
+    PRIMARY KEY (runner, episode)
+)
+"""
+
+
+class WorkQueue:
+    """
+    SQLite-backed queue of (runner, episode) tasks shared by workers.
+
+    path str: Database file. Every worker and the coordinator must use the same file.
+        Lease and retry times come from the clock of each host, so hosts sharing a queue need synchronized clocks.
+    lease float: Seconds a leased task is held without renewal before other workers may take it over. Default: 600
+    max_attempts int: Number of leases before a task is marked as failed. Default: 3
+    retry_delay float: Seconds to wait before a failed task is retried, multiplied by its attempts. Default: 60
+    """
+
+    def __init__(self, path: str, lease: float = 600, max_attempts: int = 3, retry_delay: float = 60):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lease = lease  # type: float
+        self._max_attempts = max_attempts  # type: int
+        self._retry_delay = retry_delay  # type: float
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._connection.execute(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def enqueue(self, runner: str, episodes: Iterable[int], reset: bool = False) -> int:
+        """
+        Add tasks which are not already in the queue. If reset is True, failed tasks of the episodes are set back to
+        pending. Return number of tasks added or reset.
+        """
+        rows = [(runner, episode) for episode in episodes]
+        with self._transaction() as cursor:
+            cursor.executemany("INSERT OR IGNORE INTO tasks (runner, episode) VALUES (?, ?)", rows)
+            count = cursor.rowcount
+            if reset:
+                cursor.executemany("UPDATE tasks SET status = ?, attempts = 0, lease_owner = NULL, "
+                                   "lease_expires = NULL, not_before = NULL, error = NULL "
+                                   "WHERE runner = ? AND episode = ? AND status = ?",
+                                   [(PENDING,) + row + (FAILED,) for row in rows])
+                count += cursor.rowcount
+        return count
+
+    def lease(self, owner: str) -> Optional[Tuple[str, int]]:
+        now = time.time()
+        with self._transaction() as cursor:
+            self._expire(cursor, now)
+            row = cursor.execute("SELECT runner, episode FROM tasks "
+                                 "WHERE status = ? AND (not_before IS NULL OR not_before <= ?) "
+                                 "ORDER BY runner, episode LIMIT 1", (PENDING, now)).fetchone()
+            if row is None:
+                return None
+            cursor.execute("UPDATE tasks SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ? "
+                           "WHERE runner = ? AND episode = ?", (LEASED, owner, now + self._lease) + tuple(row))
+        return row[0], row[1]
+
+    def complete(self, owner: str, runner: str, episode: int) -> bool:
+        """
+        Mark a task as done. Return False if the lease is no longer held by owner.
+        """
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE tasks SET status = ?, lease_owner = NULL, lease_expires = NULL, error = NULL "
+                           "WHERE runner = ? AND episode = ? AND status = ? AND lease_owner = ?",
+                           (DONE, runner, episode, LEASED, owner))
+            return cursor.rowcount > 0
+
+    def renew(self, owner: str, runner: str, episode: int) -> bool:
+        """
+        Extend the lease of a task by another lease period. Return False if the lease is no longer held by owner.
+        """
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE tasks SET lease_expires = ? "
+                           "WHERE runner = ? AND episode = ? AND status = ? AND lease_owner = ?",
+                           (time.time() + self._lease, runner, episode, LEASED, owner))
+            return cursor.rowcount > 0
+
+    def fail(self, owner: str, runner: str, episode: int, error: str) -> bool:
+        """
+        Release a task after an error. It is retried after retry_delay * attempts seconds until max_attempts is
+        reached. Return False if the lease is no longer held by owner.
+        """
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE tasks SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, lease_owner = NULL, "
+                           "lease_expires = NULL, not_before = ? + ? * attempts, error = ? "
+                           "WHERE runner = ? AND episode = ? AND status = ? AND lease_owner = ?",
+                           (self._max_attempts, PENDING, FAILED, time.time(), self._retry_delay, error, runner, episode,
+                            LEASED, owner))
+            return cursor.rowcount > 0
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def failures(self) -> List[Tuple[str, int, Optional[str]]]:
+        return self._connection.execute("SELECT runner, episode, error FROM tasks WHERE status = ? "
+                                        "ORDER BY runner, episode", (FAILED,)).fetchall()
+
+    def _expire(self, cursor: sqlite3.Cursor, now: float):
+        cursor.execute("UPDATE tasks SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, lease_owner = NULL, "
+                       "lease_expires = NULL, not_before = ? + ? * attempts, error = 'Lease expired' "
+                       "WHERE status = ? AND lease_expires < ?",
+                       (self._max_attempts, PENDING, FAILED, now, self._retry_delay, LEASED, now))
+
+    def _transaction(self) -> "_Transaction":
+        return _Transaction(self._connection)
+
+
+class _Transaction:
+    def __init__(self, connection: sqlite3.Connection):
+        self._connection = connection  # type: sqlite3.Connection
+        self._cursor = None  # type: Optional[sqlite3.Cursor]
+
+    def __enter__(self) -> sqlite3.Cursor:
+        self._cursor = self._connection.cursor()
+        # Take the write lock up front so that two workers cannot lease the same task.
+        self._cursor.execute("BEGIN IMMEDIATE")
+        return self._cursor
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._cursor.execute("COMMIT")
+        else:
+            self._cursor.execute("ROLLBACK")
+        self._cursor.close()
+
+
+__all__ = [WorkQueue, "PENDING", "LEASED", "DONE", "FAILED"]
@@ -0,0 +1,103 @@
+import time
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from avalonplex_scraper.work_queue import WorkQueue, PENDING, LEASED, DONE, FAILED
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self._temp = TemporaryDirectory()
+        self._path = str(Path(self._temp.name).joinpath("queue.sqlite"))
+        self._queues = []
+
+    def tearDown(self):
+        for queue in self._queues:
+            queue.close()
+        self._temp.cleanup()
+
+    def _queue(self, **kwargs) -> WorkQueue:
+        queue = WorkQueue(self._path, **kwargs)
+        self._queues.append(queue)
+        return queue
+
+    def test_enqueue_ignores_duplicates(self):
+        queue = self._queue()
+        self.assertEqual(queue.enqueue("runner", range(1, 4)), 3)
+        self.assertEqual(queue.enqueue("runner", range(1, 4)), 0)
+        self.assertEqual(queue.counts(), {PENDING: 3})
+
+    def test_lease_is_exclusive(self):
+        first = self._queue()
+        second = self._queue()
+        first.enqueue("runner", [1, 2])
+        tasks = [first.lease("first"), second.lease("second")]
+        self.assertEqual(sorted(tasks), [("runner", 1), ("runner", 2)])
+        self.assertIsNone(first.lease("first"))
+        self.assertEqual(first.counts(), {LEASED: 2})
+
+    def test_complete_is_idempotent(self):
+        queue = self._queue()
+        queue.enqueue("runner", [1])
+        task = queue.lease("owner")
+        self.assertTrue(queue.complete("owner", *task))
+        self.assertFalse(queue.complete("owner", *task))
+        self.assertEqual(queue.counts(), {DONE: 1})
+
+    def test_expired_lease_is_taken_over(self):
+        queue = self._queue(lease=0.05, retry_delay=0)
+        queue.enqueue("runner", [1])
+        task = queue.lease("old")
+        time.sleep(0.1)
+        self.assertEqual(queue.lease("new"), task)
+        self.assertFalse(queue.complete("old", *task))
+        self.assertTrue(queue.complete("new", *task))
+
+    def test_renew_keeps_lease(self):
+        queue = self._queue(lease=0.1, retry_delay=0)
+        queue.enqueue("runner", [1])
+        task = queue.lease("owner")
+        for _ in range(3):
+            time.sleep(0.05)
+            self.assertTrue(queue.renew("owner", *task))
+        self.assertIsNone(queue.lease("other"))
+        self.assertFalse(queue.renew("other", *task))
+        self.assertTrue(queue.complete("owner", *task))
+
+    def test_fail_waits_for_retry_delay(self):
+        queue = self._queue(max_attempts=3, retry_delay=0.1)
+        queue.enqueue("runner", [1])
+        task = queue.lease("owner")
+        self.assertTrue(queue.fail("owner", *task, "error"))
+        self.assertIsNone(queue.lease("owner"))
+        self.assertEqual(queue.counts(), {PENDING: 1})
+        time.sleep(0.15)
+        self.assertEqual(queue.lease("owner"), task)
+
+    def test_fail_stops_at_max_attempts(self):
+        queue = self._queue(max_attempts=2, retry_delay=0)
+        queue.enqueue("runner", [1])
+        for _ in range(2):
+            task = queue.lease("owner")
+            self.assertEqual(task, ("runner", 1))
+            queue.fail("owner", *task, "error")
+        self.assertIsNone(queue.lease("owner"))
+        self.assertEqual(queue.counts(), {FAILED: 1})
+        self.assertEqual(queue.failures(), [("runner", 1, "error")])
+
+    def test_reset_only_touches_failed_tasks(self):
+        queue = self._queue(max_attempts=1, retry_delay=0)
+        queue.enqueue("runner", [1, 2, 3])
+        failed = queue.lease("owner")
+        queue.fail("owner", *failed, "error")
+        done = queue.lease("owner")
+        queue.complete("owner", *done)
+        leased = queue.lease("owner")
+        self.assertEqual(queue.enqueue("runner", [1, 2, 3, 4], reset=True), 2)
+        self.assertEqual(queue.counts(), {PENDING: 2, DONE: 1, LEASED: 1})
+        self.assertTrue(queue.complete("owner", *leased))
+
+
+if __name__ == "__main__":
+    unittest.main()